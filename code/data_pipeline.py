@@ -5,11 +5,46 @@
 Contains the code to build the Data Input Pipeline for TensorFlow models.
 
 """
+import csv
 import numpy as np
+import os
 import pandas as pd
 import tensorflow as tf
 
 
+def adjust_color(img, hue_delta, saturation_factor, brightness_delta, contrast_factor):
+    """
+    Perturbs the hue, saturation, brightness and contrast of RGB images in the
+    [0, 1] range. This is the color augmentation shared by the data pipeline 
+    and the augmentation layers of the models.
+    
+    Parameters:
+    -----------
+    img: A float tensor of RGB images in the [0, 1] range, with the shape 
+         [..., height, width, 3].
+    
+    hue_delta, saturation_factor, brightness_delta, contrast_factor: The color
+        perturbations, as scalars or tensors of the shape [..., 1, 1] which 
+        broadcast against the height and width of the images.
+    
+    Returns:
+    --------
+    img: The perturbed images, clipped to the [0, 1] range.
+    
+    """
+    # Rotate the hue and scale the saturation within a single HSV roundtrip.
+    hsv = tf.image.rgb_to_hsv(img)
+    hue = tf.math.floormod(hsv[..., 0] + hue_delta, 1.0)
+    saturation = tf.clip_by_value(hsv[..., 1] * saturation_factor, 0.0, 1.0)
+    img = tf.image.hsv_to_rgb(tf.stack([hue, saturation, hsv[..., 2]], axis=-1))
+
+    # Apply the brightness and the contrast (around mid-gray) as a single affine transform.
+    brightness_delta = tf.expand_dims(brightness_delta, -1)
+    contrast_factor = tf.expand_dims(contrast_factor, -1)
+    img = img * contrast_factor + (brightness_delta + 0.5 * (1 - contrast_factor))
+    return tf.clip_by_value(img, 0.0, 1.0)
+
+
 class PipelineGenerator(object):
     """
     Creates a pipeline with the required configuration and image 
@@ -22,6 +57,9 @@ class PipelineGenerator(object):
     Parameters:
     -----------
     dataset_file: Path to the CSV file containing the list of images and labels.
+                  It can also be a glob pattern matching several CSV files 
+                  (shards) with the same header, which are then read in 
+                  parallel.
     
     images_dir: Path to the directory containing the images to be loaded.
     
@@ -49,8 +87,50 @@ class PipelineGenerator(object):
     perform_shuffle: Specify if the dataset needs to be shuffled. Default: True.
 
     shuffle_buffer_size: Specifies the buffer size to use to shuffle the CSV
-                         records. Check tensorflow.data.Dataset.shuffle() 
+                         records. The records are shuffled before the images 
+                         are loaded. Check tensorflow.data.Dataset.shuffle() 
                          documentation for more details. Default is 10000.
+                         It is not used by 'get_pipeline_tfrecord', which 
+                         takes its own buffer size of decoded records.
+
+    cache_path: Specifies where the decoded images must be cached after the 
+                first pass through the dataset. An empty string caches them in
+                memory, and any other string is used as a filename prefix on 
+                disk. The images are cached as uint8 before they are 
+                augmented, so they still get new augmentations in every epoch.
+                In training, the records are then shuffled after the cache, 
+                hence shuffle_buffer_size counts decoded records. Not 
+                supported by the DALI backend and 'get_pipeline_tfrecord'.
+                Default is None, which disables caching.
+
+    prefetch_buffer_size: Specifies the number of elements to prefetch at the
+                          end of the pipeline so that image loading overlaps 
+                          with the training step. Default is AUTOTUNE.
+
+    batch_size: Specifies the number of datapoints in each batch returned by 
+                the pipeline. When provided, the CSV records are batched before
+                the images are loaded, so that a whole batch is parsed in a 
+                single map call. Default is None, in which case the pipeline 
+                returns unbatched datapoints.
+
+    prefetch_to_gpu: Specify if the batches must be prefetched into the memory
+                     of the first GPU, so that copying them overlaps with the 
+                     training step. Applied only when the batch_size is 
+                     provided and a GPU is available. Default: False.
+
+    backend: The string representing the backend used to load the images. For 
+             possible backends, check the 'Attributes' section. Default is 
+             BACKEND_TF.
+
+    augment_on_gpu: Specify if the augmentations are applied by the model 
+                    instead, using the layers from 'models.get_augmentation_layers',
+                    in which case the pipeline only loads the images. Only 
+                    supported for the GPU_AUGMENT_MODES. Default: False.
+
+    seed: Specifies the seed from which the seeds of the random augmentations 
+          of each datapoint are derived. It also seeds the shuffling of the 
+          records, so that a given seed reproduces the augmentations of every
+          record. Default is None, in which case a random seed is used.
 
     kwargs: Any additional keywords argument that needs to be passed to the 
             make_csv_dataset function of TensorFlow.
@@ -79,6 +159,15 @@ class PipelineGenerator(object):
     MODE_MASK_MOG2_MULTICHANNEL: Configuration to make the pipeline return all 
                                  the images along with the mask concatenated 
                                  along the depth channel.
+
+    BACKEND_TF: Loads and augments the images with tensorflow.data ops on the 
+                CPU.
+
+    BACKEND_DALI: Loads the images with NVIDIA DALI, which decodes the JPEGs 
+                  and augments the images on the GPU. Requires the 'nvidia-dali'
+                  package and the batch_size parameter, and supports only the 
+                  modes in DALI_MODES. The pipeline is repeated indefinitely 
+                  and the labels have the shape (batch_size, 1).
             
     """
     # Mode declarations.
@@ -119,10 +208,35 @@ class PipelineGenerator(object):
                    MODE_HYBRID_13CHANNEL, MODE_HYBRID_16CHANNEL,
                    MODE_OPTICALFLOWONLY_6CHANNEL, MODE_MASKOPTICALFLOWONLY_7CHANNEL]
 
+    # Backend declarations.
+    BACKEND_TF = "tf"
+    BACKEND_DALI = "dali"
+
+    VALID_BACKENDS = [BACKEND_TF, BACKEND_DALI]
+
+    # The number of sequences whose images are shuffled together in MODE_FLAT_ALL.
+    _FLAT_SHUFFLE_SEQUENCE_COUNT = 100
+
+    # The number of serialized examples parsed together when loading TFRecords.
+    _TFRECORD_PARSE_BATCH_SIZE = 256
+
+    # The zoom augmentation crop scales, ranging from a 1% to 10% crop. Also used by the augmentation layers of the
+    # models.
+    ZOOM_SCALES = np.arange(0.9, 1.0, 0.02, dtype=np.float32)
+
+    # Modes supported by the DALI backend, which only reads the original images of the sequence.
+    DALI_MODES = [MODE_SINGLE, MODE_SEQUENCE]
+
+    # Modes supported by augment_on_gpu, whose datapoints are single RGB images.
+    GPU_AUGMENT_MODES = [MODE_SINGLE, MODE_FLAT_ALL]
+
     def __init__(self, dataset_file, images_dir, sequence_image_count=3,
                  label_name='has_animal', mode=MODE_ALL, image_size=(224, 224),
                  image_idx=1, resize=None, is_training=True,
-                 shuffle_buffer_size=10000, **kwargs):
+                 shuffle_buffer_size=10000, cache_path=None,
+                 prefetch_buffer_size=tf.data.experimental.AUTOTUNE,
+                 batch_size=None, prefetch_to_gpu=False, backend=BACKEND_TF, augment_on_gpu=False, seed=None,
+                 **kwargs):
         self._dataset_file = dataset_file
         self._images_dir = images_dir
         self._sequence_image_count = sequence_image_count
@@ -133,9 +247,17 @@ class PipelineGenerator(object):
         self._resize = resize
         self._is_training = is_training
         self._shuffle_buffer_size = shuffle_buffer_size
+        self._cache_path = cache_path
+        self._prefetch_buffer_size = prefetch_buffer_size
+        self._batch_size = batch_size
+        self._prefetch_to_gpu = prefetch_to_gpu
+        self._backend = backend
+        self._augment_on_gpu = augment_on_gpu
+        self._seed = seed if seed is not None else np.random.randint(2 ** 31)
         self._kwargs = kwargs
         self._AUTOTUNE = tf.data.experimental.AUTOTUNE
         self._size = None
+        self._image_col_names = None
 
         if self._mode not in self.VALID_MODES:
             raise ValueError("Invalid mode. Please select one from {}."\
@@ -145,6 +267,21 @@ class PipelineGenerator(object):
             (self._image_idx <= 0 or 
              self._image_idx > self._sequence_image_count)):
             raise IndexError("Image index is out of bounds.")
+
+        if self._augment_on_gpu and self._mode not in self.GPU_AUGMENT_MODES:
+            raise ValueError("Augmenting on the GPU is supported only for the modes {}."\
+                             .format(self.GPU_AUGMENT_MODES))
+
+        if self._backend not in self.VALID_BACKENDS:
+            raise ValueError("Invalid backend. Please select one from {}."\
+                             .format(self.VALID_BACKENDS))
+
+        if self._backend == self.BACKEND_DALI and (self._mode not in self.DALI_MODES or self._batch_size is None):
+            raise ValueError("The DALI backend requires the batch_size, and supports only the modes {}."\
+                             .format(self.DALI_MODES))
+
+        if self._backend == self.BACKEND_DALI and self._cache_path is not None:
+            raise ValueError("Caching is not supported by the DALI backend.")
         
         if self._resize:
             self._image_size = self._resize
@@ -167,9 +304,25 @@ class PipelineGenerator(object):
 
         self._parse_data = self._parser_map[self._mode]
 
+        # Compile the color augmentation with XLA, which fuses its elementwise ops without intermediate tensors. The
+        # parsers themselves cannot be compiled, since XLA has no kernels for reading and decoding the images.
+        self._color_fused_xla = tf.function(self._color_fused,
+                                            jit_compile=True,
+                                            input_signature=[tf.TensorSpec(list(self._image_size) + [3], tf.uint8),
+                                                             tf.TensorSpec([2], tf.int64)])
+
 
 
-    def _augment_img(self, img, seed, should_skip_color_aug=False):
+    def _get_augmentation_params(self, seed):
+        # Split the seed of the datapoint into independent seeds for each random operation, and draw a number in
+        # [0, 1000) which decides the color and zoom augmentations to be applied. These are drawn once per datapoint,
+        # so that all the images of a sequence share the same augmentations.
+        choice_seed, flip_seed, color_seed = tf.unstack(tf.random.experimental.stateless_split(seed, num=3))
+        aug_choice = tf.random.stateless_uniform([], choice_seed, minval=0, maxval=1000, dtype=tf.int32)
+        return aug_choice, flip_seed, color_seed
+
+    def _augment_img(self, img, aug_params, should_skip_color_aug=False):
+        aug_choice, flip_seed, color_seed = aug_params
         
         def flip(x):
             """Flip augmentation
@@ -180,7 +333,7 @@ class PipelineGenerator(object):
             Returns:
                 x: Augmented image
             """
-            x = tf.image.random_flip_left_right(x, seed=seed)
+            x = tf.image.stateless_random_flip_left_right(x, flip_seed)
             return x
 
         def color(x):
@@ -192,10 +345,7 @@ class PipelineGenerator(object):
             Returns:
                 x: Augmented image
             """
-            x = tf.image.random_hue(x, 0.08, seed=seed)
-            x = tf.image.random_saturation(x, 0.6, 1.6, seed=seed)
-            x = tf.image.random_brightness(x, 0.05, seed=seed)
-            x = tf.image.random_contrast(x, 0.7, 1.3, seed=seed)
+            x = self._color_fused_xla(x, color_seed)
             return x
         
         def zoom(x):
@@ -207,153 +357,165 @@ class PipelineGenerator(object):
             Returns:
                 x: Augmented image
             """
-            # Generate 10 crop settings, ranging from a 1% to 10% crop.
-            scales = list(np.arange(0.9, 1.0, 0.02))
-            scale = scales[seed % len(scales)]
-            
-            x1 = y1 = 0.5 - (0.5 * scale)
-            x2 = y2 = 0.5 + (0.5 * scale)
-            boxes = [x1, y1, x2, y2]
-            
-            # Create different crops for an image
-            x = tf.image.crop_and_resize([img], boxes=[boxes], 
-                                         box_indices=[0], 
-                                         crop_size=self._image_size)
+            # Pick one of the crop settings.
+            scale = tf.gather(self.ZOOM_SCALES, aug_choice % len(self.ZOOM_SCALES))
             
-            # Squeeze out the final dimension
-            x = tf.squeeze(x)
+            # Crop the center of the image at integer offsets, and resize it back to the image size.
+            height, width = self._image_size
+            crop_height = tf.cast(height * scale, tf.int32)
+            crop_width = tf.cast(width * scale, tf.int32)
+            x = tf.image.crop_to_bounding_box(x, (height - crop_height) // 2, (width - crop_width) // 2,
+                                              crop_height, crop_width)
+            x = tf.image.resize(x, [height, width], method="bilinear")
+
+            # Round back to uint8
+            x = tf.saturate_cast(tf.round(x), tf.uint8)
             
             return x
 
-        # Augment images only in training mode.
-        if not self._is_training:
-            return img
+        # Augment images only in training mode, and only if the model does not augment them itself.
+        if not self._is_training or self._augment_on_gpu:
+            return self._to_float(img)
 
+        # The augmentations keep the image as uint8, which also keeps the values within [0, 255].
         img = flip(img)
 
-        if seed < 500 and not should_skip_color_aug:
-            img = color(img)
-        
-        if seed >= 250 and seed < 750:
-            img = zoom(img)
+        if not should_skip_color_aug:
+            img = tf.cond(aug_choice < 500, lambda: color(img), lambda: img)
+
+        img = tf.cond((aug_choice >= 250) & (aug_choice < 750), lambda: zoom(img), lambda: img)
         
-        return tf.clip_by_value(img, 0, 1)
+        return self._to_float(img)
+
+    def _color_fused(self, img, seed):
+        # Draw the color perturbations from the same ranges as the tf.image.stateless_random_* ops would.
+        hue_seed, saturation_seed, brightness_seed, contrast_seed = \
+            tf.unstack(tf.random.experimental.stateless_split(seed, num=4))
+        hue_delta = tf.random.stateless_uniform([], hue_seed, minval=-0.08, maxval=0.08)
+        saturation_factor = tf.random.stateless_uniform([], saturation_seed, minval=0.6, maxval=1.6)
+        brightness_delta = tf.random.stateless_uniform([], brightness_seed, minval=-0.05, maxval=0.05)
+        contrast_factor = tf.random.stateless_uniform([], contrast_seed, minval=0.7, maxval=1.3)
+
+        img = adjust_color(self._to_float(img), hue_delta, saturation_factor, brightness_delta, contrast_factor)
+        return tf.image.convert_image_dtype(img, tf.uint8, saturate=True)
+
+    def _to_float(self, img):
+        # Use `convert_image_dtype` to convert to floats in the [0,1] range.
+        return tf.image.convert_image_dtype(img, tf.float32)
     
     
+    def _decode_jpeg_scaled(self, img, num_channels):
+        # Pick the largest JPEG scaling ratio (1, 2, 4 or 8) for which the decoded image is still at least as
+        # large as the target size, so that the decoder skips the high frequencies which are resized away anyway.
+        jpeg_shape = tf.image.extract_jpeg_shape(img)
+        max_ratio = tf.minimum(jpeg_shape[0] // self._resize[0], jpeg_shape[1] // self._resize[1])
+        ratio_idx = tf.reduce_sum(tf.cast(max_ratio >= tf.constant([2, 4, 8]), tf.int32))
+
+        # The ratio must be a constant of the decode op, hence decode with one branch per ratio.
+        decode_branches = [lambda ratio=ratio: tf.image.decode_jpeg(img, channels=num_channels, ratio=ratio,
+                                                                    dct_method="INTEGER_FAST")
+                           for ratio in [1, 2, 4, 8]]
+        return tf.switch_case(ratio_idx, decode_branches)
+
     def _decode_img(self, img, is_mask=False):
         # XXX: is_mask and num_channels can be merged. Keeping it separate for minimizing code change.
-        # Convert the compressed string to a uint8 tensor
-        if is_mask:
-            img = tf.image.decode_image(img, channels=1)
-            img.set_shape(self._image_size + (1,))
-        else:    
-            img = tf.image.decode_image(img, channels=3)
-            img.set_shape(self._image_size + (3,))
-
-        # Use `convert_image_dtype` to convert to floats in the [0,1] range.
-        img = tf.image.convert_image_dtype(img, tf.float32)
+        num_channels = 1 if is_mask else 3
 
-        # Resize the image to the desired size if needed.
         if self._resize:
+            # Decode JPEGs directly at a reduced scale, and resize the image to the exact desired size.
+            img = tf.cond(tf.image.is_jpeg(img),
+                          lambda: self._decode_jpeg_scaled(img, num_channels),
+                          lambda: tf.image.decode_image(img, channels=num_channels, expand_animations=False))
             img = tf.image.resize(img, list(self._resize), name="resize-input")
+            img = tf.saturate_cast(tf.round(img), tf.uint8)
+        else:
+            # Convert the compressed string to a uint8 tensor
+            img = tf.image.decode_image(img, channels=num_channels)
+            img.set_shape(self._image_size + (num_channels,))
 
+        # The image is kept as uint8 until it has been augmented.
         return img
 
+    def _load_img(self, img, is_mask=False):
+        # Images from TFRecords are already decoded, otherwise the metadata holds the contents of the image file.
+        if img.dtype == tf.uint8:
+            return img
+
+        return self._decode_img(img, is_mask=is_mask)
+
     
-    def _parse_data_all(self, metadata, label):
+    def _parse_data_all(self, metadata, label, aug_params):
         data_point = {}
-        seed = np.random.randint(1000)
         
         # Read each image and add to dictionary
         for img_num in range(1, self._sequence_image_count + 1):
             img_name = "image" + str(img_num)
-            img = tf.io.read_file(tf.strings.join([
-                self._images_dir, metadata[img_name]]))
-            img = self._decode_img(img)
-            img = self._augment_img(img, seed)
+            img = self._load_img(metadata[img_name])
+            img = self._augment_img(img, aug_params)
             data_point[img_name] = img
 
         return data_point, label
     
     
-    def _parse_data_single(self, metadata, label):
-        img = tf.io.read_file(tf.strings.join([
-                self._images_dir, metadata["image" + str(self._image_idx)]]))
-        img = self._decode_img(img)
+    def _parse_data_single(self, metadata, label, aug_params):
+        img = self._load_img(metadata["image" + str(self._image_idx)])
         
-        seed = np.random.randint(1000)
-        img = self._augment_img(img, seed)
+        img = self._augment_img(img, aug_params)
         return img, label
     
     
-    def _parse_data_mask_mog2_single(self, metadata, label):
+    def _parse_data_mask_mog2_single(self, metadata, label, aug_params):
         # Read the image
-        img = tf.io.read_file(tf.strings.join([
-                self._images_dir, metadata["image" + str(self._image_idx)]]))
-        img = self._decode_img(img)
+        img = self._load_img(metadata["image" + str(self._image_idx)])
         
         # Read the mask
-        mask = tf.io.read_file(tf.strings.join([self._images_dir, 
-                                                metadata['mask_MOG2']]))
-        mask = self._decode_img(mask, is_mask=True)
+        mask = self._load_img(metadata['mask_MOG2'], is_mask=True)
         
         # Augment the image and the mask
-        seed = np.random.randint(1000)
-        img = self._augment_img(img, seed)
-        mask = self._augment_img(mask, seed, should_skip_color_aug=True)
+        img = self._augment_img(img, aug_params)
+        mask = self._augment_img(mask, aug_params, should_skip_color_aug=True)
         
         # Append the mask to the image
         final_image = tf.concat([img, mask], axis=2)
         
         return final_image, label
 
-    def _parse_data_flat(self, metadata, label):
+    def _parse_data_flat(self, metadata, label, aug_params):
         images, labels = [], []
-        seed = np.random.randint(1000)
         
         # Read each image and add to list
         for img_num in range(1, self._sequence_image_count + 1):
-            img = tf.io.read_file(tf.strings.join([
-                self._images_dir, metadata["image" + str(img_num)]]))
-            img = self._decode_img(img)
-            img = self._augment_img(img, seed)
+            img = self._load_img(metadata["image" + str(img_num)])
+            img = self._augment_img(img, aug_params)
             images.append(img)
             labels.append(label)
         
-        return tf.data.Dataset.from_tensor_slices((images, labels))
+        return tf.stack(images), tf.stack(labels)
     
     
-    def _parse_data_sequence(self, metadata, label):
+    def _parse_data_sequence(self, metadata, label, aug_params):
         images = []
-        seed = np.random.randint(1000)
         
         # Read each image and add to list
         for img_num in range(1, self._sequence_image_count + 1):
-            img = tf.io.read_file(tf.strings.join([
-                self._images_dir, metadata["image" + str(img_num)]]))
-            img = self._decode_img(img)
-            img = self._augment_img(img, seed)
+            img = self._load_img(metadata["image" + str(img_num)])
+            img = self._augment_img(img, aug_params)
             images.append(img)
         
         return tf.convert_to_tensor(images), label
     
     
-    def _parse_data_mask_mog2_sequence(self, metadata, label):
+    def _parse_data_mask_mog2_sequence(self, metadata, label, aug_params):
         images = []
-        seed = np.random.randint(1000)
         
         # Read and augment the mask
-        mask = tf.io.read_file(tf.strings.join([self._images_dir, 
-                                                metadata['mask_MOG2']]))
-        mask = self._decode_img(mask, is_mask=True)
-        mask = self._augment_img(mask, seed, should_skip_color_aug=True)
+        mask = self._load_img(metadata['mask_MOG2'], is_mask=True)
+        mask = self._augment_img(mask, aug_params, should_skip_color_aug=True)
         
         # Read each image, augment it, append the mask and add it to the list
         for img_num in range(1, self._sequence_image_count + 1):
-            img = tf.io.read_file(tf.strings.join([
-                    self._images_dir, metadata["image" + str(img_num)]]))
-            img = self._decode_img(img)
-            img = self._augment_img(img, seed)
+            img = self._load_img(metadata["image" + str(img_num)])
+            img = self._augment_img(img, aug_params)
             
             # Append the mask to the image
             final_image = tf.concat([img, mask], axis=2)
@@ -362,48 +524,40 @@ class PipelineGenerator(object):
         return tf.convert_to_tensor(images), label
 
 
-    def _parse_data_mask_mog2_multichannel(self, metadata, label):
+    def _parse_data_mask_mog2_multichannel(self, metadata, label, aug_params):
         images = []
-        seed = np.random.randint(1000)
         
         # Read each image, augment it and add it to the list
         for img_num in range(1, self._sequence_image_count + 1):
-            img = tf.io.read_file(tf.strings.join([
-                    self._images_dir, metadata["image" + str(img_num)]]))
-            img = self._decode_img(img)
-            img = self._augment_img(img, seed)
+            img = self._load_img(metadata["image" + str(img_num)])
+            img = self._augment_img(img, aug_params)
             images.append(img)
             
         # Read and augment the mask. Add it to the list
-        mask = tf.io.read_file(tf.strings.join([self._images_dir, 
-                                                metadata['mask_MOG2']]))
-        mask = self._decode_img(mask, is_mask=True)
-        mask = self._augment_img(mask, seed, should_skip_color_aug=True)
+        mask = self._load_img(metadata['mask_MOG2'], is_mask=True)
+        mask = self._augment_img(mask, aug_params, should_skip_color_aug=True)
         images.append(mask)
         
         # Append all the images and the mask
         final_image = tf.concat(images, axis=2)
         return final_image, label
 
-    def _parse_data_opticalflow_single(self, metadata, label):
+    def _parse_data_opticalflow_single(self, metadata, label, aug_params):
         # Read the image
-        img = tf.io.read_file(tf.strings.join([self._images_dir, metadata["image" + str(self._image_idx)]]))
-        img = self._decode_img(img)
+        img = self._load_img(metadata["image" + str(self._image_idx)])
 
         # Read the opticalflow "average" image.
-        opticalflow_avg = tf.io.read_file(tf.strings.join([self._images_dir, metadata['opticalflowGF_average']]))
-        opticalflow_avg = self._decode_img(opticalflow_avg)  # Treat opticalflow as a normal image since it is RGB image.
+        opticalflow_avg = self._load_img(metadata['opticalflowGF_average'])  # Treat opticalflow as a normal image since it is RGB image.
 
         # Augment the image and the mask
-        seed = np.random.randint(1000)
-        img = self._augment_img(img, seed)
-        opticalflow_avg = self._augment_img(opticalflow_avg, seed, should_skip_color_aug=True)
+        img = self._augment_img(img, aug_params)
+        opticalflow_avg = self._augment_img(opticalflow_avg, aug_params, should_skip_color_aug=True)
 
         # Append the opticalflow channels to the image
         final_image = tf.concat([img, opticalflow_avg], axis=2)
         return final_image, label
 
-    def _parse_data_opticalflow_multichannel(self, metadata, label):
+    def _parse_data_opticalflow_multichannel(self, metadata, label, aug_params):
         # Note: Provide 'sequence_image_count' as the number of original images, and do not include
         # opticalflow images in it, but provide the right number of channels.
         # List of tuples: [(image_column_name, flag)]
@@ -416,45 +570,39 @@ class PipelineGenerator(object):
 
         # Read each image, augment it if it not opticalflow image and add it to the list.
         images = []
-        seed = np.random.randint(1000)
         for column_name, should_skip_color_aug in image_names_should_skip_color_aug_flags:
-            img = tf.io.read_file(tf.strings.join([self._images_dir, metadata[column_name]]))
-            img = self._decode_img(img)
-            img = self._augment_img(img, seed, should_skip_color_aug=should_skip_color_aug)
+            img = self._load_img(metadata[column_name])
+            img = self._augment_img(img, aug_params, should_skip_color_aug=should_skip_color_aug)
             images.append(img)
 
         # Append all the images and the mask
         final_image = tf.concat(images, axis=2)
         return final_image, label
 
-    def _parse_data_hybrid_13channel(self, metadata, label):
+    def _parse_data_hybrid_13channel(self, metadata, label, aug_params):
         images = []
-        seed = np.random.randint(1000)
 
         # Read each image, augment it and add it to the list
         for img_num in range(1, self._sequence_image_count + 1):
-            img = tf.io.read_file(tf.strings.join([self._images_dir, metadata["image" + str(img_num)]]))
-            img = self._decode_img(img)
-            img = self._augment_img(img, seed)
+            img = self._load_img(metadata["image" + str(img_num)])
+            img = self._augment_img(img, aug_params)
             images.append(img)
 
         # Read and augment the OpticalFlow-Average. Add it to the list
-        opticalflow_avg = tf.io.read_file(tf.strings.join([self._images_dir, metadata['opticalflowGF_average']]))
-        opticalflow_avg = self._decode_img(opticalflow_avg)
-        opticalflow_avg = self._augment_img(opticalflow_avg, seed, should_skip_color_aug=True)
+        opticalflow_avg = self._load_img(metadata['opticalflowGF_average'])
+        opticalflow_avg = self._augment_img(opticalflow_avg, aug_params, should_skip_color_aug=True)
         images.append(opticalflow_avg)
 
         # Read and augment the mask. Add it to the list
-        mask = tf.io.read_file(tf.strings.join([self._images_dir, metadata['mask_MOG2']]))
-        mask = self._decode_img(mask, is_mask=True)
-        mask = self._augment_img(mask, seed, should_skip_color_aug=True)
+        mask = self._load_img(metadata['mask_MOG2'], is_mask=True)
+        mask = self._augment_img(mask, aug_params, should_skip_color_aug=True)
         images.append(mask)
 
         # Append all the images and the mask
         final_image = tf.concat(images, axis=2)
         return final_image, label
 
-    def _parse_data_hybrid_16channel(self, metadata, label):
+    def _parse_data_hybrid_16channel(self, metadata, label, aug_params):
         # Note: Provide 'sequence_image_count' as the number of original images, and do not include
         # opticalflow images in it, but provide the right number of channels.
         # List of tuples: [(image_column_name, flag)]
@@ -467,63 +615,321 @@ class PipelineGenerator(object):
 
         # Read each image, augment it if it not opticalflow image and add it to the list.
         images = []
-        seed = np.random.randint(1000)
         for column_name, should_skip_color_aug in image_names_should_skip_color_aug_flags:
-            img = tf.io.read_file(tf.strings.join([self._images_dir, metadata[column_name]]))
-            img = self._decode_img(img)
-            img = self._augment_img(img, seed, should_skip_color_aug=should_skip_color_aug)
+            img = self._load_img(metadata[column_name])
+            img = self._augment_img(img, aug_params, should_skip_color_aug=should_skip_color_aug)
             images.append(img)
 
         # Read and augment the mask. Add it to the list
-        mask = tf.io.read_file(tf.strings.join([self._images_dir, metadata['mask_MOG2']]))
-        mask = self._decode_img(mask, is_mask=True)
-        mask = self._augment_img(mask, seed, should_skip_color_aug=True)
+        mask = self._load_img(metadata['mask_MOG2'], is_mask=True)
+        mask = self._augment_img(mask, aug_params, should_skip_color_aug=True)
         images.append(mask)
 
         # Append all the images and the mask
         final_image = tf.concat(images, axis=2)
         return final_image, label
 
-    def _parse_data_opticalflowonly_6channel(self, metadata, label):
-        seed = np.random.randint(1000)
+    def _parse_data_opticalflowonly_6channel(self, metadata, label, aug_params):
         # Read the opticalflow 1 and 2 images.
-        opticalflow_1 = tf.io.read_file(tf.strings.join([self._images_dir, metadata['opticalflowGF_1']]))
-        opticalflow_1 = self._decode_img(opticalflow_1)  # Treat opticalflow as a normal image since it is RGB image.
-        opticalflow_1 = self._augment_img(opticalflow_1, seed, should_skip_color_aug=True)
+        opticalflow_1 = self._load_img(metadata['opticalflowGF_1'])  # Treat opticalflow as a normal image since it is RGB image.
+        opticalflow_1 = self._augment_img(opticalflow_1, aug_params, should_skip_color_aug=True)
 
-        opticalflow_2 = tf.io.read_file(tf.strings.join([self._images_dir, metadata['opticalflowGF_2']]))
-        opticalflow_2 = self._decode_img(opticalflow_2)  # Treat opticalflow as a normal image since it is RGB image.
-        opticalflow_2 = self._augment_img(opticalflow_2, seed, should_skip_color_aug=True)
+        opticalflow_2 = self._load_img(metadata['opticalflowGF_2'])  # Treat opticalflow as a normal image since it is RGB image.
+        opticalflow_2 = self._augment_img(opticalflow_2, aug_params, should_skip_color_aug=True)
 
         # Append the opticalflow channels to the image
         final_image = tf.concat([opticalflow_1, opticalflow_2], axis=2)
         return final_image, label
 
-    def _parse_data_maskopticalflowonly_7channel(self, metadata, label):
-        seed = np.random.randint(1000)
+    def _parse_data_maskopticalflowonly_7channel(self, metadata, label, aug_params):
         # Read the opticalflow 1 and 2 images.
-        opticalflow_1 = tf.io.read_file(tf.strings.join([self._images_dir, metadata['opticalflowGF_1']]))
-        opticalflow_1 = self._decode_img(opticalflow_1)  # Treat opticalflow as a normal image since it is RGB image.
-        opticalflow_1 = self._augment_img(opticalflow_1, seed, should_skip_color_aug=True)
+        opticalflow_1 = self._load_img(metadata['opticalflowGF_1'])  # Treat opticalflow as a normal image since it is RGB image.
+        opticalflow_1 = self._augment_img(opticalflow_1, aug_params, should_skip_color_aug=True)
 
-        opticalflow_2 = tf.io.read_file(tf.strings.join([self._images_dir, metadata['opticalflowGF_2']]))
-        opticalflow_2 = self._decode_img(opticalflow_2)  # Treat opticalflow as a normal image since it is RGB image.
-        opticalflow_2 = self._augment_img(opticalflow_2, seed, should_skip_color_aug=True)
+        opticalflow_2 = self._load_img(metadata['opticalflowGF_2'])  # Treat opticalflow as a normal image since it is RGB image.
+        opticalflow_2 = self._augment_img(opticalflow_2, aug_params, should_skip_color_aug=True)
 
         # Read and augment the mask. Add it to the list
-        mask = tf.io.read_file(tf.strings.join([self._images_dir, metadata['mask_MOG2']]))
-        mask = self._decode_img(mask, is_mask=True)
-        mask = self._augment_img(mask, seed, should_skip_color_aug=True)
+        mask = self._load_img(metadata['mask_MOG2'], is_mask=True)
+        mask = self._augment_img(mask, aug_params, should_skip_color_aug=True)
 
         # Append the opticalflow channels to the image
         final_image = tf.concat([opticalflow_1, opticalflow_2, mask], axis=2)
         return final_image, label
 
+    def _get_seed(self, count):
+        # Derive the stateless seed of a datapoint from the seed of the pipeline and the position of the datapoint.
+        return tf.random.experimental.stateless_split(tf.stack([tf.constant(self._seed, tf.int64), count]), num=1)[0]
+
+    def _parse_record(self, record, count):
+        metadata, label = record
+        return self._parse_data(metadata, label, self._get_augmentation_params(self._get_seed(count)))
+
+    def _parse_batch(self, records, counts):
+        # Parse all the datapoints of the batch in parallel within one map call.
+        metadata, labels = records
+        if self._mode == self.MODE_ALL:
+            image_dtype = {"image" + str(img_num): tf.float32
+                           for img_num in range(1, self._sequence_image_count + 1)}
+        else:
+            image_dtype = tf.float32
+
+        def parse_datapoint(datapoint):
+            datapoint_metadata, label, count = datapoint
+            return self._parse_data(datapoint_metadata, label, self._get_augmentation_params(self._get_seed(count)))
+
+        images, labels = tf.map_fn(parse_datapoint,
+                                   (metadata, labels, counts),
+                                   fn_output_signature=(image_dtype, labels.dtype),
+                                   parallel_iterations=self._batch_size)
+        return images, labels
+
+    def _get_dali_pipeline(self, file_paths, labels):
+        # NVIDIA DALI is an optional dependency, which is needed only by the DALI backend.
+        try:
+            import nvidia.dali.fn as fn
+            import nvidia.dali.plugin.tf as dali_tf
+            import nvidia.dali.types as types
+            from nvidia.dali import pipeline_def
+        except ImportError:
+            raise ImportError("The DALI backend requires NVIDIA DALI. Please install the 'nvidia-dali' package.")
+
+        if self._mode == self.MODE_SINGLE:
+            column_names = ["image" + str(self._image_idx)]
+        else:
+            column_names = ["image" + str(img_num) for img_num in range(1, self._sequence_image_count + 1)]
+
+        height, width = self._image_size
+
+        # As in _augment_img, augment only in training mode, and only if the model does not augment the images itself.
+        should_augment = self._is_training and not self._augment_on_gpu
+
+        @pipeline_def(batch_size=self._batch_size, num_threads=os.cpu_count(), device_id=0)
+        def dali_pipeline():
+            # Draw the augmentations once per sequence, so that all of its images are augmented alike. The color and
+            # zoom augmentations are each applied to half of the sequences, like in _augment_img.
+            if should_augment:
+                mirror = fn.random.coin_flip()
+                should_color = fn.random.coin_flip()
+                should_zoom = fn.random.coin_flip()
+                hue = fn.random.uniform(range=[-0.08 * 360, 0.08 * 360]) * should_color
+                saturation = 1 + (fn.random.uniform(range=[0.6, 1.6]) - 1) * should_color
+                brightness_shift = fn.random.uniform(range=[-0.05, 0.05]) * should_color
+                contrast = 1 + (fn.random.uniform(range=[0.7, 1.3]) - 1) * should_color
+                scale = 1 - (1 - fn.random.uniform(values=self.ZOOM_SCALES.tolist())) * should_zoom
+                roi_start = fn.stack(0.5 - (0.5 * scale), 0.5 - (0.5 * scale))
+                roi_end = fn.stack(0.5 + (0.5 * scale), 0.5 + (0.5 * scale))
+            else:
+                mirror = 0
+                roi_start, roi_end = [0.0, 0.0], [1.0, 1.0]
+
+            images = []
+            for column_name in column_names:
+                # With shuffle_after_epoch, DALI shuffles the files with its own fixed seed rather than the seed
+                # argument. Hence the readers of all the columns, which list the records in the same order, keep
+                # returning the images of the same records together.
+                encoded, labels_out = fn.readers.file(file_root=self._images_dir,
+                                                      files=list(file_paths[column_name]),
+                                                      labels=[int(label) for label in labels],
+                                                      random_shuffle=False,
+                                                      shuffle_after_epoch=self._is_training,
+                                                      name="reader-" + column_name)
+
+                # Decode on the GPU, and crop the zoomed area while resizing to the desired size.
+                img = fn.decoders.image(encoded, device="mixed", output_type=types.RGB)
+                img = fn.resize(img, size=[height, width], roi_start=roi_start, roi_end=roi_end, roi_relative=True)
+                if should_augment:
+                    img = fn.hsv(img, hue=hue, saturation=saturation)
+                    img = fn.brightness_contrast(img, brightness_shift=brightness_shift, contrast=contrast)
+
+                # Flip and convert to floats in the [0,1] range.
+                img = fn.crop_mirror_normalize(img, dtype=types.FLOAT, output_layout="HWC",
+                                               mean=[0.0], std=[255.0], mirror=mirror)
+                images.append(img)
+
+            if self._mode == self.MODE_SEQUENCE:
+                return fn.stack(*images), labels_out.gpu()
+            return images[0], labels_out.gpu()
+
+        if self._mode == self.MODE_SEQUENCE:
+            images_shape = (self._batch_size, self._sequence_image_count, height, width, 3)
+        else:
+            images_shape = (self._batch_size, height, width, 3)
+
+        with tf.device("/gpu:0"):
+            dataset_images = dali_tf.DALIDataset(pipeline=dali_pipeline(),
+                                                 batch_size=self._batch_size,
+                                                 output_shapes=(images_shape, (self._batch_size, 1)),
+                                                 output_dtypes=(tf.float32, tf.int32),
+                                                 device_id=0)
+        return dataset_images
+
     def get_size(self):
         if self._size is None:
             print("Size cannot be determined before the 'get_pipeline' function call. Returning None.")
         return self._size
 
+    def _get_mode_col_names(self):
+        # The columns of the CSV file which are read by the parser of the mode.
+        image_col_names = ["image" + str(img_num) for img_num in range(1, self._sequence_image_count + 1)]
+        selected_image_col_names = ["image" + str(self._image_idx)]
+        opticalflow_col_names = ["opticalflowGF_" + str(i) for i in range(1, self._sequence_image_count)]
+
+        mode_col_names = {
+            self.MODE_ALL: image_col_names,
+            self.MODE_FLAT_ALL: image_col_names,
+            self.MODE_SINGLE: selected_image_col_names,
+            self.MODE_SEQUENCE: image_col_names,
+            self.MODE_MASK_MOG2_SINGLE: selected_image_col_names + ['mask_MOG2'],
+            self.MODE_MASK_MOG2_SEQUENCE: image_col_names + ['mask_MOG2'],
+            self.MODE_MASK_MOG2_MULTICHANNEL: image_col_names + ['mask_MOG2'],
+            self.MODE_OPTICALFLOW_SINGLE: selected_image_col_names + ['opticalflowGF_average'],
+            self.MODE_OPTICALFLOW_MULTICHANNEL: image_col_names + opticalflow_col_names,
+            self.MODE_HYBRID_13CHANNEL: image_col_names + ['opticalflowGF_average', 'mask_MOG2'],
+            self.MODE_HYBRID_16CHANNEL: image_col_names + opticalflow_col_names + ['mask_MOG2'],
+            self.MODE_OPTICALFLOWONLY_6CHANNEL: ['opticalflowGF_1', 'opticalflowGF_2'],
+            self.MODE_MASKOPTICALFLOWONLY_7CHANNEL: ['opticalflowGF_1', 'opticalflowGF_2', 'mask_MOG2']
+        }
+        return mode_col_names[self._mode]
+
+    def _read_header(self):
+        # Read only the header of the CSV files, and count their records to set the size attribute.
+        csv_file_paths = sorted(tf.io.gfile.glob(self._dataset_file))
+        if not csv_file_paths:
+            raise ValueError("No CSV files match the dataset_file: %s" % self._dataset_file)
+
+        self._size = 0
+        for csv_file_path in csv_file_paths:
+            with tf.io.gfile.GFile(csv_file_path) as csv_file:
+                column_names = next(csv.reader(csv_file))
+                self._size += sum(1 for _ in csv_file)
+
+        if self._mode == self.MODE_FLAT_ALL:
+            self._size = self._size * self._sequence_image_count
+
+        # Keep only the columns of the images which are loaded by the mode.
+        self._image_col_names = self._get_mode_col_names()
+
+        return column_names
+
+    def _get_csv_dataset(self):
+        # Stream the image columns and the label from the CSV files. The selected columns must be in the file order.
+        column_names = self._read_header()
+        selected_col_names = sorted(self._image_col_names + [self._label_name], key=column_names.index)
+        record_defaults = [tf.int64 if column_name == self._label_name else tf.string
+                           for column_name in selected_col_names]
+        select_cols = [column_names.index(column_name) for column_name in selected_col_names]
+
+        # Read the CSV files in parallel, when the dataset_file is sharded. Unlike the image reads, the records are
+        # returned in a deterministic order even in training, since the seeded shuffle and the augmentation seeds
+        # derived from the record order must be reproducible. Reading the small CSV records is not the bottleneck.
+        csv_files = tf.data.Dataset.list_files(self._dataset_file, shuffle=self._is_training, seed=self._seed)
+        dataset_records = csv_files.interleave(lambda csv_file: tf.data.experimental.CsvDataset(csv_file,
+                                                                                                record_defaults,
+                                                                                                header=True,
+                                                                                                select_cols=select_cols),
+                                               cycle_length=self._AUTOTUNE,
+                                               num_parallel_calls=self._AUTOTUNE,
+                                               deterministic=True)
+
+        def pack_record(*values):
+            record = dict(zip(selected_col_names, values))
+            label = record.pop(self._label_name)
+
+            # Prefix the images directory to the file names, so that the pipeline reads the full paths.
+            image_paths = tf.strings.join([self._images_dir, tf.stack([record[column_name]
+                                                                       for column_name in self._image_col_names])])
+            return dict(zip(self._image_col_names, tf.unstack(image_paths))), label
+
+        return dataset_records.map(pack_record, num_parallel_calls=self._AUTOTUNE)
+
+    def _read_files(self, record, count):
+        # Read the files of all the image columns of the record concurrently, and put their contents back together.
+        metadata, label = record
+        file_contents = tf.data.Dataset.from_tensor_slices(tf.stack([metadata[column_name]
+                                                                     for column_name in self._image_col_names]))
+        file_contents = file_contents.map(tf.io.read_file, num_parallel_calls=self._AUTOTUNE)
+        file_contents = file_contents.batch(len(self._image_col_names))
+
+        return file_contents.map(lambda contents: (({column_name: contents[col_idx]
+                                                     for col_idx, column_name in enumerate(self._image_col_names)},
+                                                    label),
+                                                   count))
+
+    def _build_pipeline(self, dataset_files, is_shuffled=False):
+        # Parse the data and load the images.
+        is_batch_parsed = self._batch_size is not None and self._mode != self.MODE_FLAT_ALL
+
+        # In training, let the records whose images load faster overtake the slower ones. The augmentation seeds are
+        # assigned to the records before their files are read, so the order does not change the augmentations.
+        is_deterministic = not self._is_training
+
+        # Decode the images once and cache them as uint8, before the shuffle and the repeat of the training mode. The
+        # images are augmented after the cache, so they still get new augmentations in every epoch.
+        if self._cache_path is not None:
+            dataset_files = dataset_files.map(self._decode_record, num_parallel_calls=self._AUTOTUNE)
+            dataset_files = dataset_files.cache(self._cache_path)
+
+        if self._is_training and not is_shuffled:
+            # Shuffle the records before parsing, so that the shuffle buffer holds only the file paths, unless the
+            # decoded images are cached.
+            dataset_files = dataset_files.shuffle(buffer_size=self._shuffle_buffer_size, seed=self._seed,
+                                                  reshuffle_each_iteration=True)
+
+            # Repeat before parsing, so that the datapoints get new augmentation seeds in every epoch.
+            dataset_files = dataset_files.repeat()
+
+        # Number the records, from which the seeds of their random augmentations are derived.
+        dataset_files = tf.data.Dataset.zip((dataset_files, tf.data.experimental.Counter()))
+
+        # Read the image files of many records concurrently, unless the images are already decoded (from TFRecords).
+        if any(spec.dtype == tf.string for spec in dataset_files.element_spec[0][0].values()):
+            dataset_files = dataset_files.interleave(self._read_files,
+                                                     cycle_length=self._AUTOTUNE,
+                                                     num_parallel_calls=self._AUTOTUNE,
+                                                     deterministic=is_deterministic)
+
+        if is_batch_parsed:
+            dataset_images = dataset_files.batch(self._batch_size)
+            dataset_images = dataset_images.map(self._parse_batch, num_parallel_calls=self._AUTOTUNE,
+                                                deterministic=is_deterministic)
+        else:
+            dataset_images = dataset_files.map(self._parse_record, num_parallel_calls=self._AUTOTUNE,
+                                               deterministic=is_deterministic)
+
+            # Split the stacked images of each sequence into separate datapoints.
+            if self._mode == self.MODE_FLAT_ALL:
+                dataset_images = dataset_images.unbatch()
+
+        if self._is_training:
+            # Mix the images of the neighbouring sequences, which are otherwise returned one after the other.
+            if self._mode == self.MODE_FLAT_ALL:
+                dataset_images = dataset_images.shuffle(buffer_size=self._FLAT_SHUFFLE_SEQUENCE_COUNT * self._sequence_image_count,
+                                                        reshuffle_each_iteration=True)
+            print("Note: The dataset is being prepared for training mode. "
+                  "It has been shuffled, and repeated indefinitely.")
+
+        if self._batch_size is not None and not is_batch_parsed:
+            dataset_images = dataset_images.batch(self._batch_size)
+
+        # Prefetch so that the images are loaded while the model is training.
+        dataset_images = dataset_images.prefetch(self._prefetch_buffer_size)
+
+        # Let tf.data fuse and parallelize the ops.
+        options = tf.data.Options()
+        options.experimental_deterministic = is_deterministic
+        options.experimental_optimization.map_and_batch_fusion = True
+        options.experimental_optimization.parallel_batch = True
+        options.experimental_threading.private_threadpool_size = os.cpu_count()
+        dataset_images = dataset_images.with_options(options)
+
+        # Copy the batches to the GPU ahead of the training step. This must be the last transformation.
+        if self._prefetch_to_gpu and self._batch_size is not None and tf.config.list_physical_devices('GPU'):
+            dataset_images = dataset_images.apply(
+                tf.data.experimental.prefetch_to_device('/GPU:0', buffer_size=self._prefetch_buffer_size))
+
+        return dataset_images
+
     def get_pipeline(self):
         """
         Returns a pipeline that was constructed using the parameters specified.
@@ -533,31 +939,124 @@ class PipelineGenerator(object):
         dataset_images: A tensorflow.data.Dataset pipeline object.
         
         """
-        # Create a dataset with records from the CSV file.
-        data_csv = pd.read_csv(self._dataset_file)
+        # The DALI backend reads and augments the images within its own pipeline, which requires the file lists.
+        if self._backend == self.BACKEND_DALI:
+            self._read_header()
+            data_csv = pd.concat([pd.read_csv(csv_file_path, usecols=self._image_col_names + [self._label_name])
+                                  for csv_file_path in sorted(tf.io.gfile.glob(self._dataset_file))])
+            return self._get_dali_pipeline(data_csv[self._image_col_names], data_csv[self._label_name].values)
+
+        dataset_files = self._get_csv_dataset()
+        return self._build_pipeline(dataset_files)
+
+    def _decode_record(self, metadata, label):
+        # Decode all the images of the record as uint8 tensors, to be stored in the TFRecords.
+        images = {}
+        for column_name in self._image_col_names:
+            images[column_name] = self._decode_img(tf.io.read_file(metadata[column_name]),
+                                                   is_mask=column_name.startswith('mask'))
+
+        return images, label
+
+    def to_tfrecord(self, out_dir, num_shards):
+        """
+        Decodes the images listed in the CSV file once, and writes them as 
+        uint8 tensors along with the labels to TFRecord files, which can be 
+        loaded using the 'get_pipeline_tfrecord' function. Only the image 
+        columns used by the mode are stored, after resizing, but without any 
+        augmentation.
+        
+        Parameters:
+        -----------
+        out_dir: Path to the directory to which the TFRecord files must be 
+                 written. It must not already exist.
+        
+        num_shards: The number of TFRecord files to write the records to. For 
+                    efficient reading, choose it such that each file is about
+                    100 MB.
+        
+        """
+        dataset_files = self._get_csv_dataset()
+        dataset_images = dataset_files.map(self._decode_record, num_parallel_calls=self._AUTOTUNE)
+        dataset_images = dataset_images.prefetch(self._AUTOTUNE)
+
+        os.makedirs(out_dir)
+        writers = [tf.io.TFRecordWriter(os.path.join(out_dir, "shard-%05d-of-%05d.tfrecord" % (shard_idx, num_shards)))
+                   for shard_idx in range(num_shards)]
+
+        for record_idx, (images, label) in enumerate(dataset_images):
+            feature = {column_name: tf.train.Feature(bytes_list=tf.train.BytesList(value=[img.numpy().tobytes()]))
+                       for column_name, img in images.items()}
+            feature[self._label_name] = tf.train.Feature(int64_list=tf.train.Int64List(value=[label.numpy()]))
+            example = tf.train.Example(features=tf.train.Features(feature=feature))
+            writers[record_idx % num_shards].write(example.SerializeToString())
+
+        for writer in writers:
+            writer.close()
+
+    def _parse_examples(self, serialized_examples):
+        # Parse a batch of serialized examples back into the decoded images and the labels.
+        features = {column_name: tf.io.FixedLenFeature([], tf.string) for column_name in self._image_col_names}
+        features[self._label_name] = tf.io.FixedLenFeature([], tf.int64)
+        examples = tf.io.parse_example(serialized_examples, features)
+
+        metadata = {}
+        for column_name in self._image_col_names:
+            num_channels = 1 if column_name.startswith('mask') else 3
+            img = tf.io.decode_raw(examples[column_name], tf.uint8)
+            metadata[column_name] = tf.reshape(img, [-1] + list(self._image_size) + [num_channels])
+
+        return metadata, examples[self._label_name]
+
+    def get_pipeline_tfrecord(self, tfrecord_dir, shuffle_buffer_size=256):
+        """
+        Returns a pipeline similar to 'get_pipeline', which loads the decoded 
+        images from the TFRecord files written by the 'to_tfrecord' function 
+        instead of decoding the images listed in the CSV file.
+        
+        Parameters:
+        -----------
+        tfrecord_dir: Path to the directory containing the TFRecord files.
+        
+        shuffle_buffer_size: Specifies the buffer size to use to shuffle the 
+                             records in training mode. Each record holds all 
+                             the decoded images of a datapoint, so the buffer 
+                             must be much smaller than for the CSV records. 
+                             The order of the TFRecord files is shuffled in 
+                             every epoch as well. Default is 256.
+        
+        Returns:
+        --------
+        dataset_images: A tensorflow.data.Dataset pipeline object.
+        
+        """
+        if self._cache_path is not None:
+            raise ValueError("Caching is not supported when loading TFRecords, which already hold the decoded images.")
 
-        # Set the size attribute.
-        self._size = len(data_csv)
-        if self._mode == self.MODE_FLAT_ALL:
-            self._size = self._size * self._sequence_image_count
+        # The CSV file is still read to determine the size and the image columns.
+        self._read_header()
 
-        image_col_names = ["image" + str(img_num) for img_num in range(1, self._sequence_image_count + 1)]
-        mask_columns = [mask_col for mask_col in data_csv.columns if (mask_col.startswith('mask') or mask_col.startswith('opticalflow'))]
-        image_col_names.extend(mask_columns)
-        labels = data_csv[[self._label_name]]
-        file_paths = data_csv[image_col_names]
-        dataset_files = tf.data.Dataset.from_tensor_slices((file_paths.to_dict('list'), labels.values.reshape(-1, )))
+        tfrecord_files = tf.data.Dataset.list_files(os.path.join(tfrecord_dir, "*.tfrecord"),
+                                                    shuffle=self._is_training, seed=self._seed)
 
-        # Parse the data and load the images.
-        if self._mode == self.MODE_FLAT_ALL:
-            dataset_images = dataset_files.flat_map(self._parse_data)
-        else:
-            dataset_images = dataset_files.map(self._parse_data, num_parallel_calls=self._AUTOTUNE)
+        # Repeat the files rather than the records, so that the order of the files is shuffled again in every epoch.
+        if self._is_training:
+            tfrecord_files = tfrecord_files.repeat()
+
+        # Read the records of many files at once, which mixes them before the small shuffle buffer. The order of the
+        # records is kept deterministic, since the augmentation seeds are derived from it.
+        dataset_records = tfrecord_files.interleave(tf.data.TFRecordDataset,
+                                                    cycle_length=self._AUTOTUNE,
+                                                    num_parallel_calls=self._AUTOTUNE,
+                                                    deterministic=True)
+
+        # Parse the examples in batches, and unbatch them to be parsed as the records read from the CSV file.
+        dataset_files = dataset_records.batch(self._TFRECORD_PARSE_BATCH_SIZE)
+        dataset_files = dataset_files.map(self._parse_examples, num_parallel_calls=self._AUTOTUNE)
+        dataset_files = dataset_files.unbatch()
 
         if self._is_training:
-            dataset_images = dataset_images.shuffle(buffer_size=self._shuffle_buffer_size, reshuffle_each_iteration=True)
-            dataset_images = dataset_images.repeat()
-            print("Note: The dataset is being prepared for training mode. "
-                  "It has been shuffled, and repeated indefinitely.")
+            dataset_files = dataset_files.shuffle(buffer_size=shuffle_buffer_size, seed=self._seed,
+                                                  reshuffle_each_iteration=True)
 
-        return dataset_images
+        return self._build_pipeline(dataset_files, is_shuffled=True)
@@ -69,6 +69,9 @@ def get_args():
                         type=int,
                         default=3,
                         help="The number of input channels expected by the data pipeline. Default: 3.")
+    parser.add_argument('--augment-on-gpu',
+                        action='store_true',
+                        help="Specify if the model was trained with the augmentation layers (--augment-on-gpu).")
 
     args = parser.parse_args()
 
@@ -143,13 +146,15 @@ def get_layer_outputs(model, required_layers, input_tensors):
     return savers
 
 
-def load_and_get_model_for_inference(trained_model_arch, trained_checkpoint_dir, filetype, input_shape, num_classes):
+def load_and_get_model_for_inference(trained_model_arch, trained_checkpoint_dir, filetype, input_shape, num_classes,
+                                     augment_on_gpu=False):
     model_factory = ModelFactory()
     model = model_factory.get_model(trained_model_arch,
                                     input_shape,
                                     is_training=False,
                                     num_classes=num_classes,
-                                    learning_rate=0.001)  # A dummy learning rate since it is test mode.
+                                    learning_rate=0.001,  # A dummy learning rate since it is test mode.
+                                    augment_on_gpu=augment_on_gpu)
     # The ModelCheckpoint in train pipeline saves the weights inside the checkpoint directory as follows.
     if filetype == '.h5':
         weights_path = trained_checkpoint_dir + "best_model_dir-auc.h5"
@@ -228,7 +233,8 @@ def inference_pipeline(test_metadata_file_path,
                        data_pipeline_mode="mode_flat_all",
                        batch_size=32,
                        input_size=(224, 224, 3),
-                       extract_layers=None):
+                       extract_layers=None,
+                       augment_on_gpu=False):
     """
     Evaluates the provided trained model on the given test set. If it is not a sequence model
     (i.e., a single image model), then it returns both first-image and max-probability results.
@@ -246,6 +252,7 @@ def inference_pipeline(test_metadata_file_path,
     :param batch_size: The batch size used for the data. Ensure that it fits within the GPU memory. Default: 32.
     :param input_size: The shape of the tensors returned by the data pipeline mode. Default: (224, 224, 3).
     :param extract_layers: The names of the model layers (as a comma separated values) to be extracted.
+    :param augment_on_gpu: Specify if the model was trained with the augmentation layers. Default: False.
 
     """
     def _get_preds_labels(model, test_input_tensors, test_labels):
@@ -289,15 +296,16 @@ def inference_pipeline(test_metadata_file_path,
                                      is_training=False,
                                      sequence_image_count=sequence_image_count,
                                      label_name=label_name,
-                                     mode=pipeline_mode)  # We always use sequence level inference during evaluation.
+                                     mode=pipeline_mode,  # We always use sequence level inference during evaluation.
+                                     batch_size=batch_size)
 
-    test_dataset_raw = pipeline_gen.get_pipeline()
-    test_dataset_batches = test_dataset_raw.batch(batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+    test_dataset_batches = pipeline_gen.get_pipeline()
     num_test_sequences = pipeline_gen.get_size()
     print("There are %s test sequences." % num_test_sequences)
 
     # Create the model architecture and load the trained weights from checkpoint dir.
-    model = load_and_get_model_for_inference(trained_model_arch, trained_checkpoint_dir, filetype, input_size, num_classes)
+    model = load_and_get_model_for_inference(trained_model_arch, trained_checkpoint_dir, filetype, input_size, num_classes,
+                                             augment_on_gpu=augment_on_gpu)
 
     # Extract the predicted probabilities and corresponding labels.
     # This would be a list of (pred, label) tuples if this is_sequence_model.
@@ -356,11 +364,15 @@ def inference_pipeline(test_metadata_file_path,
     if extract_layers:
         print("\nExtracting the outputs at intermediate layers.")
         savers_outpath = os.path.join(out_dir, "extracted_layer_outputs_dict.pickle")
+
+        # The layers of the model architecture are nested in the last layer of a model with the augmentation layers,
+        # which do not alter the images at inference, so the nested model can be run directly.
+        layers_model = model.layers[-1] if augment_on_gpu else model
         if is_sequence_model:
-            savers = get_layer_outputs(model, extract_layers, test_sequences)
+            savers = get_layer_outputs(layers_model, extract_layers, test_sequences)
         else:
             # Consider the first image for individual image models.
-            savers = get_layer_outputs(model, extract_layers, test_sequences[:, 0, :, :])
+            savers = get_layer_outputs(layers_model, extract_layers, test_sequences[:, 0, :, :])
         with open(savers_outpath, "wb") as fp:
             pickle.dump(savers, fp)
         print("The outputs at these model layers - %s - from the last batch have been saved to: %s"
@@ -399,4 +411,5 @@ if __name__ == "__main__":
                        data_pipeline_mode=args.data_pipeline_mode,
                        batch_size=args.batch_size,
                        input_size=input_size,
-                       extract_layers=args.extract_layers)
+                       extract_layers=args.extract_layers,
+                       augment_on_gpu=args.augment_on_gpu)
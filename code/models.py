@@ -17,6 +17,8 @@ from tensorflow import keras
 from tensorflow.keras import layers
 from tensorflow.keras.layers import LSTM, TimeDistributed
 
+from data_pipeline import PipelineGenerator, adjust_color
+
 
 def _add_conv_block(num_filters, inputs, is_training, name_prefix, kernel_regularizer=None):
     """Adds a Batchnorm enabled convolution block.
@@ -894,6 +896,109 @@ def resnet152_7channel_allpretrained_maskopticalflow(input_shape, is_training=Fa
     return model
 
 
+class RandomColor(layers.Layer):
+    """
+    Randomly perturbs the hue, saturation, brightness and contrast of half of the RGB images in the [0, 1] range, like
+    the color augmentation of the data pipeline. The images are returned unchanged outside of training.
+
+    """
+    def call(self, inputs, training=None):
+        if training is None:
+            training = keras.backend.learning_phase()
+
+        def augment():
+            batch_size = tf.shape(inputs)[0]
+            factor_shape = [batch_size, 1, 1]
+            outputs = adjust_color(inputs,
+                                   tf.random.uniform(factor_shape, minval=-0.08, maxval=0.08),
+                                   tf.random.uniform(factor_shape, minval=0.6, maxval=1.6),
+                                   tf.random.uniform(factor_shape, minval=-0.05, maxval=0.05),
+                                   tf.random.uniform(factor_shape, minval=0.7, maxval=1.3))
+
+            # Keep the original colors for the other half of the images.
+            should_color = tf.random.uniform([batch_size, 1, 1, 1]) < 0.5
+            return tf.where(should_color, outputs, inputs)
+
+        return keras.backend.in_train_phase(augment, inputs, training=training)
+
+
+class RandomCenterZoom(layers.Layer):
+    """
+    Crops the center of half of the images and resizes it back to the image size, picking the crop scale from
+    PipelineGenerator.ZOOM_SCALES, like the zoom augmentation of the data pipeline. The images are returned unchanged
+    outside of training.
+
+    """
+    def call(self, inputs, training=None):
+        if training is None:
+            training = keras.backend.learning_phase()
+
+        def augment():
+            batch_size = tf.shape(inputs)[0]
+            height, width = inputs.shape[1], inputs.shape[2]
+
+            # Pick a crop scale for each image, and keep the whole image for the other half of the images.
+            zoom_scales = tf.constant(PipelineGenerator.ZOOM_SCALES)
+            scales = tf.gather(zoom_scales, tf.random.uniform([batch_size], maxval=len(PipelineGenerator.ZOOM_SCALES),
+                                                              dtype=tf.int32))
+            scales = tf.where(tf.random.uniform([batch_size]) < 0.5, scales, 1.0)
+
+            # Crop the center at integer offsets, as the data pipeline does, and resize all the crops at once.
+            crop_height = tf.cast(height * scales, tf.int32)
+            crop_width = tf.cast(width * scales, tf.int32)
+            offset_height = (height - crop_height) // 2
+            offset_width = (width - crop_width) // 2
+            boxes = tf.stack([tf.cast(offset_height, tf.float32) / (height - 1),
+                              tf.cast(offset_width, tf.float32) / (width - 1),
+                              tf.cast(offset_height + crop_height - 1, tf.float32) / (height - 1),
+                              tf.cast(offset_width + crop_width - 1, tf.float32) / (width - 1)], axis=1)
+            return tf.image.crop_and_resize(inputs, boxes, tf.range(batch_size), [height, width])
+
+        return keras.backend.in_train_phase(augment, inputs, training=training)
+
+
+def get_augmentation_layers(input_shape):
+    """
+    Builds the Keras preprocessing layers which apply the data pipeline augmentations on the device running the model.
+    As in the data pipeline, every image is flipped, color perturbed and zoomed, each with a probability of 0.5.
+
+    :param input_shape: The shape of the input RGB images (do not consider the batch-dimension).
+    :return: The tf.Keras Sequential model of the augmentation layers.
+
+    """
+    if len(input_shape) != 3 or input_shape[-1] != 3:
+        raise ValueError("The augmentation layers support only RGB inputs of shape (height, width, 3).")
+
+    return keras.Sequential([layers.experimental.preprocessing.RandomFlip("horizontal", name="augment_flip"),
+                             RandomColor(name="augment_color"),
+                             RandomCenterZoom(name="augment_zoom")],
+                            name="augmentation")
+
+
+def add_augmentation_layers(model, input_shape):
+    """
+    Prepends the augmentation layers to a compiled model, and compiles the resulting model with the same optimizer and
+    loss.
+
+    :param model: The compiled tf.Keras model.
+    :param input_shape: The shape of the input images (do not consider the batch-dimension).
+    :return: The constructed tf.Keras model (Functional), with the same name as the given model.
+
+    """
+    inputs = keras.Input(shape=input_shape, name='input')
+    augmented_inputs = get_augmentation_layers(input_shape)(inputs)
+    predictions = model(augmented_inputs)
+
+    augmented_model = keras.Model(inputs=inputs, outputs=predictions, name=model.name)
+    # Name the AUC metric explicitly, since the model's own AUC metric has already taken the default name, and the
+    # train pipeline monitors 'val_auc'.
+    augmented_model.compile(optimizer=model.optimizer,
+                            loss=model.loss,
+                            metrics=['accuracy', keras.metrics.AUC(curve='ROC', name='auc')])
+
+    return augmented_model
+
+
 # The dictionary mapping model names to model architecture functions.
 # Ensure that the name of the model architecture matches with the model's 'name' attribute.
 AVAILABLE_MODEL_ARCHS = {
@@ -939,8 +1044,15 @@ class ModelFactory(object):
     def __init__(self):
         print("Available model architectures are: %s" % AVAILABLE_MODEL_ARCHS.keys())
 
-    def get_model(self, model_arch, input_shape, is_training=False, num_classes=1, learning_rate=0.001):
-        return AVAILABLE_MODEL_ARCHS[model_arch](input_shape,
-                                                 is_training=is_training,
-                                                 num_classes=num_classes,
-                                                 learning_rate=learning_rate)
+    def get_model(self, model_arch, input_shape, is_training=False, num_classes=1, learning_rate=0.001,
+                  augment_on_gpu=False):
+        model = AVAILABLE_MODEL_ARCHS[model_arch](input_shape,
+                                                  is_training=is_training,
+                                                  num_classes=num_classes,
+                                                  learning_rate=learning_rate)
+
+        # Augment the images within the model, when the data pipeline does not augment them.
+        if augment_on_gpu:
+            model = add_augmentation_layers(model, input_shape)
+
+        return model
@@ -38,6 +38,9 @@ def get_args():
     parser.add_argument('--data-pipeline-mode',
                         required=True,
                         help="The mode to be used for the data pipeline.")
+    parser.add_argument('--data-pipeline-backend',
+                        default="tf",
+                        help="The backend used by the data pipeline to load the images, 'tf' or 'dali'. Default: tf.")
     parser.add_argument('--batch-size',
                         type=int,
                         default=64,
@@ -71,6 +74,18 @@ def get_args():
                         type=int,
                         default=3,
                         help="The number of input channels expected by the data pipeline. Default: 3.")
+    parser.add_argument('--prefetch-to-gpu',
+                        action='store_true',
+                        help="Prefetch the training batches into the GPU memory.")
+    parser.add_argument('--augment-on-gpu',
+                        action='store_true',
+                        help="Augment the images with preprocessing layers in the model instead of the data pipeline. "
+                             "Supported only for the single RGB image modes.")
+    parser.add_argument('--cache-train-images',
+                        action='store_true',
+                        help="Cache the decoded training images on disk in the out-dir, so that they are decoded only "
+                             "once. They are still augmented in every epoch. The validation images are always cached "
+                             "with the 'tf' backend.")
 
     args = parser.parse_args()
 
@@ -86,13 +101,17 @@ def train(train_metadata_file_path,
           label_name=None,
           sequence_image_count=1,
           data_pipeline_mode="mode_flat_all",
+          data_pipeline_backend="tf",
           class_weight=None,
           whole_epochs=100,
           batch_size=32,
           learning_rate=0.001,
           patience=2,
           min_delta_auc=0.01,
-          input_size=(224, 224, 3)):
+          input_size=(224, 224, 3),
+          augment_on_gpu=False,
+          prefetch_to_gpu=False,
+          cache_train_images=False):
     """
     Train a VGG16 model based on single image.
 
@@ -105,6 +124,7 @@ def train(train_metadata_file_path,
     :param label_name: Required if num_classes=1. The name of the label to pick from the data.
     :param sequence_image_count: The number of images in the sequence dataset. Default: 1.
     :param data_pipeline_mode: The mode of the data pipeline. Default: "mode_flat_all".
+    :param data_pipeline_backend: The backend used by the data pipeline to load the images. Default: "tf".
     :param class_weight: The class_weights for imbalanced data. Example: {0: 1.0, 1: 0.5}, if class "0" is twice less
         represented than class "1" in your data. Default: None.
     :param whole_epochs: The maximum number of epochs to be trained. Note that the model maybe early-stopped. Default: 100.
@@ -113,6 +133,11 @@ def train(train_metadata_file_path,
     :param patience: The number of epochs (full train dataset) to wait before early stopping. Default: 2.
     :param min_delta_auc: The minimum delta of validation auc for early stopping after patience. Default: 0.01.
     :param input_size: The shape of the tensors returned by the data pipeline mode. Default: (224, 224, 3).
+    :param augment_on_gpu: Augment the images with preprocessing layers in the model instead of the data pipeline.
+        Default: False.
+    :param prefetch_to_gpu: Prefetch the training batches into the GPU memory. Default: False.
+    :param cache_train_images: Cache the decoded training images on disk in the out_dir. The validation images, which
+        are read in every epoch, are always cached when the data_pipeline_backend is "tf". Default: False.
 
     """
     if num_classes == 1 and label_name is None:
@@ -126,13 +151,20 @@ def train(train_metadata_file_path,
 
     os.makedirs(out_dir)
 
+    # Cache the decoded images on disk in the out_dir, which is not supported by the DALI backend.
+    is_cache_supported = data_pipeline_backend == PipelineGenerator.BACKEND_TF
+    if cache_train_images and not is_cache_supported:
+        raise ValueError("Caching the training images requires the data_pipeline_backend '%s'."
+                         % PipelineGenerator.BACKEND_TF)
+
     # Build model architecture.
     model_factory = ModelFactory()
     model = model_factory.get_model(model_arch,
                                     input_size,
                                     is_training=True,
                                     num_classes=num_classes,
-                                    learning_rate=learning_rate)
+                                    learning_rate=learning_rate,
+                                    augment_on_gpu=augment_on_gpu)
     print("Created the model architecture: %s" % model.name)
     model.summary()
 
@@ -144,9 +176,15 @@ def train(train_metadata_file_path,
                                             is_training=True,
                                             sequence_image_count=sequence_image_count,
                                             label_name=label_name,
-                                            mode=data_pipeline_mode)
+                                            mode=data_pipeline_mode,
+                                            backend=data_pipeline_backend,
+                                            augment_on_gpu=augment_on_gpu,
+                                            prefetch_to_gpu=prefetch_to_gpu,
+                                            batch_size=batch_size,
+                                            prefetch_buffer_size=prefetch_buffer_size,
+                                            cache_path=os.path.join(out_dir, "train_images_cache")
+                                                       if cache_train_images else None)
     train_dataset = train_data_pipeline.get_pipeline()
-    train_dataset = train_dataset.batch(batch_size).prefetch(prefetch_buffer_size)
 
     # Prepare the validation dataset
     val_data_pipeline = PipelineGenerator(val_metadata_file_path,
@@ -154,9 +192,13 @@ def train(train_metadata_file_path,
                                           is_training=False,
                                           sequence_image_count=sequence_image_count,
                                           label_name=label_name,
-                                          mode=data_pipeline_mode)
+                                          mode=data_pipeline_mode,
+                                          backend=data_pipeline_backend,
+                                          batch_size=batch_size,
+                                          prefetch_buffer_size=prefetch_buffer_size,
+                                          cache_path=os.path.join(out_dir, "val_images_cache")
+                                                     if is_cache_supported else None)
     val_dataset = val_data_pipeline.get_pipeline()
-    val_dataset = val_dataset.batch(batch_size).prefetch(prefetch_buffer_size)
 
     # TODO: Find a way to log the activation maps, either during training, or after the training has completed.
 
@@ -226,7 +268,8 @@ def train(train_metadata_file_path,
               epochs=max_num_epochs,
               steps_per_epoch=steps_per_epoch,
               validation_data=val_dataset,
-              validation_steps=num_val_steps_per_whole_dataset,
+              # Run through the whole (finite) validation dataset, so that its cache is completed in the first epoch.
+              validation_steps=None if is_cache_supported else num_val_steps_per_whole_dataset,
               callbacks=callbacks,
               class_weight=class_weight)
 
@@ -261,10 +304,14 @@ if __name__ == "__main__":
           label_name=label_name,
           sequence_image_count=args.sequence_image_count,
           data_pipeline_mode=args.data_pipeline_mode,
+          data_pipeline_backend=args.data_pipeline_backend,
           class_weight=None,
           whole_epochs=args.epochs,
           batch_size=args.batch_size,
           learning_rate=args.learning_rate,
           patience=args.patience,
           min_delta_auc=args.min_delta_auc,
-          input_size=input_size)
+          input_size=input_size,
+          augment_on_gpu=args.augment_on_gpu,
+          prefetch_to_gpu=args.prefetch_to_gpu,
+          cache_train_images=args.cache_train_images)